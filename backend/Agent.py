@@ -1,15 +1,27 @@
+import asyncio
+import hashlib
 import os
+import threading
 import time
 import uuid
-from typing import List, Dict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterator, Optional, Tuple
 from dotenv import load_dotenv
+import faiss
+import numpy as np
+import orjson
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # --- Gemini SDK (direct official API) ---
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # --- LangChain utilities we still use ---
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 
@@ -26,41 +38,138 @@ genai.configure(api_key=API_KEY)
 VECTOR_STORE_DIR = "vector_stores"
 os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
 
+# Texts per batch_embed_contents request; Gemini accepts at most 100
+EMBED_BATCH_SIZE = min(int(os.getenv("LEBY_EMBED_BATCH", "100")), 100)
+# Embedding batch requests allowed in flight at once
+EMBED_MAX_CONCURRENCY = int(os.getenv("LEBY_EMBED_CONCURRENCY", "5"))
+# Embedding API requests per minute allowed by the project's Gemini quota
+EMBED_RPM = float(os.getenv("LEBY_EMBED_RPM", "1500"))
+
 
 # ---------------------------------------------------------------------
 # 2. EMBEDDINGS WRAPPER
 # ---------------------------------------------------------------------
+def _normalize(vectors) -> np.ndarray:
+    """L2-normalize each row so inner product equals cosine similarity."""
+    arr = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(arr, axis=-1, keepdims=True)
+    return arr / np.maximum(norms, 1e-10)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills at `rate_per_min`, bursts up to one
+    second's worth of requests. acquire() only blocks once the bucket is empty.
+    """
+
+    def __init__(self, rate_per_min: float):
+        self.rate = rate_per_min / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Transient quota / availability errors are retried with backoff; anything else,
+# or a fifth failure, propagates so the index never misaligns with its texts
+_EMBED_RETRY = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type(
+        (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)
+    ),
+    reraise=True,
+)
+
+
 class GoogleSDKEmbeddings(Embeddings):
     """
     Lightweight wrapper using Gemini's official embeddings API.
-    Avoids storing huge arrays; each chunk is embedded individually.
+    Chunks are sent `batch_size` at a time, one batch_embed_contents request each,
+    with up to `max_concurrent` requests in flight.
+    Vectors are returned unit-length, for use with an inner-product index.
     """
 
-    def __init__(self, model: str = "models/gemini-embedding-001"):
+    def __init__(
+        self,
+        model: str = "models/gemini-embedding-001",
+        batch_size: int = EMBED_BATCH_SIZE,
+        max_concurrent: int = EMBED_MAX_CONCURRENCY,
+    ):
         self.model = model
+        self.batch_size = batch_size
+        self.max_concurrent = max_concurrent
+        self.limiter = TokenBucket(EMBED_RPM)
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    @_EMBED_RETRY
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        self.limiter.acquire()
+        # A list payload makes the SDK issue one batch request for the whole slice
+        result = genai.embed_content(
+            model=self.model,
+            content=batch,
+            task_type="retrieval_document",
+        )
+        return result["embedding"]
+
+    @staticmethod
+    def _fill_matrix(results: List[List[List[float]]], n: int) -> np.ndarray:
+        """Copy per-batch results into one contiguous (n, dim) float32 buffer, unit rows."""
+        if n == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        buf = np.empty((n, len(results[0][0])), dtype=np.float32)
+        row = 0
+        for batch in results:
+            buf[row:row + len(batch)] = batch
+            row += len(batch)
+        buf /= np.maximum(np.linalg.norm(buf, axis=1, keepdims=True), 1e-10)
+        return buf
+
+    def _embed_matrix(self, texts: List[str]) -> np.ndarray:
+        """Embed `texts` straight into an ndarray ready for faiss (no per-float boxing)."""
+        # pool.map yields results in batch order, so rows line up with texts
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as pool:
+            results = list(pool.map(self._embed_batch, self._batches(texts)))
+        return self._fill_matrix(results, len(texts))
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        vectors = []
-        for text in texts:
-            try:
-                result = genai.embed_content(
-                    model=self.model,
-                    content=text,
-                    task_type="retrieval_document",
-                )
-                vectors.append(result["embedding"])
-                time.sleep(0.05)  # small rate-limit cushion
-            except Exception as e:
-                print(f"[EMB] Skipped chunk due to error: {e}")
-        return vectors
+        return self._embed_matrix(texts).tolist()
 
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        sem = asyncio.Semaphore(self.max_concurrent)
+
+        async def _one(batch: List[str]) -> List[List[float]]:
+            async with sem:
+                return await asyncio.to_thread(self._embed_batch, batch)
+
+        # gather preserves argument order, so rows line up with texts
+        results = await asyncio.gather(*(_one(b) for b in self._batches(texts)))
+        return self._fill_matrix(results, len(texts)).tolist()
+
+    @_EMBED_RETRY
     def embed_query(self, text: str) -> List[float]:
+        self.limiter.acquire()
         result = genai.embed_content(
             model=self.model,
             content=text,
             task_type="retrieval_query",
         )
-        return result["embedding"]
+        return _normalize(result["embedding"]).tolist()
 
 
 EMB = GoogleSDKEmbeddings()
@@ -70,25 +179,290 @@ EMB = GoogleSDKEmbeddings()
 # 3. MODEL PICKER (ROBUST FALLBACK)
 # ---------------------------------------------------------------------
 
-CHAT_MODEL = "gemini-2.5-flash"
+# Chosen by configuration, not by probing the API at import time
+CHAT_MODEL = os.getenv("GEMINI_CHAT_MODEL", "gemini-2.5-flash")
+NO_RESPONSE = "⚠️ No response generated."
+
+# One client per process; reused by every summary and Q&A call
+_CHAT = genai.GenerativeModel(CHAT_MODEL)
+
+# Prompt templates: built once here, filled with a single .format() per call
+_SUMMARY_TEMPLATE = (
+    "You are a Senior Legal Document Specialist.\n"
+    "Generate a high-level executive summary of the provided text.\n\n"
+    "REQUIREMENTS:\n"
+    "- Tone: Formal, objective, and precise.\n"
+    "- Format: Use professional markdown with semantic headers.\n"
+    "- Sections: Executive Overview, Key Parties, Significant Obligations, Critical Deadlines, and Potential Red Flags.\n\n"
+    "Document Text Segment:\n"
+    "{excerpt}\n\n"
+    "Deliver the summary directly without any introductory conversational text."
+)
+
+_QA_TEMPLATE = (
+    "{persona}\n\n"
+    "{context_guidance}\n\n"
+    "RESPONSE STYLE:\n"
+    "- Tone: Authoritative, professional, but accessible.\n"
+    "- Structure: Primary Answer -> Action Steps -> Strategic Considerations.\n"
+    "- Conciseness: Maximum 200 words.\n\n"
+    "{history_block}"
+    "User Question: {query}\n\n"
+    "--- Context / Strategic Instructions ---\n"
+    "{context}\n"
+    "{safety_block}"
+    "------------------------------------------\n\n"
+    "Now deliver your final guidance in professional markdown."
+)
+
+_HISTORY_TEMPLATE = (
+    "Condense this legal Q&A conversation into a factual summary of about 150 words.\n"
+    "Keep the user's situation, key facts, advice already given, and open questions.\n\n"
+    "Existing summary:\n{summary}\n\n"
+    "New turns:\n{turns}\n\n"
+    "Return only the summary."
+)
+
+_GENERAL_CONTEXT = "General Legal Help - No specific document context provided. You are to act as a general legal assistant advising on common legal issues based on your instructions. Note: This is an ungrounded chat about the user's generic problem."
+_GENERAL_PERSONA = (
+    "You are an elite legal strategist. You are providing general guidance without a specific document.\n"
+    "FOCUS: Practical first steps, risk mitigation, and identifying which specialist (e.g., criminal lawyer, employment tribunal) is needed."
+)
+_GENERAL_GUIDANCE = (
+    "Since no document is uploaded, provide high-level strategic advice based on general legal principles. "
+    "Structure your response with clear, actionable bullet points."
+)
+_DOCUMENT_PERSONA = (
+    "You are an elite legal analyst. Use the provided document as your sole source of truth."
+)
+_DOCUMENT_GUIDANCE = (
+    "Always ground your answer in the provided document context. If the document is silent, "
+    "state so clearly and then provide best-practice guidance as a secondary measure."
+)
 
 
 # ---------------------------------------------------------------------
 # 4. HELPERS
 # ---------------------------------------------------------------------
-def _chunk_text(full_text: str) -> List[Document]:
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1500, chunk_overlap=200, separators=["\n\n", "\n", " ", ""]
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1500, chunk_overlap=200, separators=["\n\n", "\n", " ", ""]
+)
+
+
+def _chunk_text(full_text: str) -> List[str]:
+    return _SPLITTER.split_text(full_text)
+
+
+def _dedupe_chunks(texts: List[str]) -> List[str]:
+    """
+    Drop repeated chunks (headers, footers, recitals) before embedding.
+    Keyed on case- and whitespace-normalized text, so trivially different copies also go.
+    """
+    seen = set()
+    unique = []
+    for t in texts:
+        h = hashlib.sha256(" ".join(t.lower().split()).encode("utf-8")).hexdigest()
+        if h not in seen:
+            seen.add(h)
+            unique.append(t)
+    return unique
+
+
+# HNSW graph parameters: M links per node, build/search beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+# From this many chunks on, store vectors as 8-bit codes (4x smaller than float32).
+# Smaller sets stay float32: too few vectors to estimate per-dimension ranges.
+SQ8_MIN_VECTORS = 1000
+# From this many chunks on, switch to IVF-PQ: sqrt(N) lists, 64 sub-quantizers x 8 bits.
+# The dimension must split evenly into the sub-quantizers.
+IVFPQ_MIN_VECTORS = 100_000
+IVFPQ_M = 64
+IVFPQ_NPROBE = 16
+
+
+def _build_faiss(texts: List[str], vectors: np.ndarray) -> FAISS:
+    """
+    Wrap an inner-product index over `vectors` in LangChain's FAISS store.
+    HNSW keeps search cost ~log(N) instead of a full scan; large sets are
+    scalar-quantized to 8 bits per dimension, very large ones go to IVF-PQ.
+    """
+    matrix = np.ascontiguousarray(vectors, dtype=np.float32)  # no copy for _embed_matrix output
+    n, dim = matrix.shape
+    if n >= IVFPQ_MIN_VECTORS and dim % IVFPQ_M == 0:
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, int(np.sqrt(n)), IVFPQ_M, 8, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(matrix)
+        index.nprobe = IVFPQ_NPROBE
+    else:
+        if n >= SQ8_MIN_VECTORS:
+            index = faiss.IndexHNSWSQ(
+                dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(matrix)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    index.add(matrix)
+
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({i: Document(page_content=t) for i, t in zip(ids, texts)})
+    return FAISS(
+        EMB,
+        index,
+        docstore,
+        dict(enumerate(ids)),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
     )
-    return splitter.split_documents([Document(page_content=full_text)])
+
+
+# Summaries keyed by sha256 of the summarized text; identical documents skip Gemini
+SUMMARY_CACHE_SIZE = 128
+_SUMMARY_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_SUMMARY_LOCK = threading.Lock()
+
+
+def _cached_summary(key: str) -> Optional[str]:
+    with _SUMMARY_LOCK:
+        summary = _SUMMARY_CACHE.get(key)
+        if summary is not None:
+            _SUMMARY_CACHE.move_to_end(key)
+        return summary
+
+
+def _store_summary(key: str, summary: str) -> None:
+    with _SUMMARY_LOCK:
+        _SUMMARY_CACHE[key] = summary
+        _SUMMARY_CACHE.move_to_end(key)
+        while len(_SUMMARY_CACHE) > SUMMARY_CACHE_SIZE:
+            _SUMMARY_CACHE.popitem(last=False)
+
+
+# Semantic answer cache for opening questions, shared by every session on the same
+# document (keyed by sha256 of its text). Later turns depend on the conversation so
+# far, so only answers given with no history are stored or reused.
+# Cosine similarity above which a previous answer is reused for a new question
+QA_CACHE_THRESHOLD = 0.92
+# Documents whose answers are kept, least recently used evicted first
+QA_CACHE_DOCS = 128
+# Answers kept per document before its cache starts over
+QA_CACHE_SIZE = 64
+_QA_CACHE: "OrderedDict[str, Tuple[faiss.IndexFlatIP, List[str]]]" = OrderedDict()
+_QA_LOCK = threading.Lock()
+
+
+def _cached_answer(doc_key: str, query_vec: List[float]) -> Optional[str]:
+    with _QA_LOCK:
+        entry = _QA_CACHE.get(doc_key)
+        if entry is None:
+            return None
+        _QA_CACHE.move_to_end(doc_key)
+        index, answers = entry
+        # Unit vectors: inner product = cosine
+        scores, ids = index.search(np.asarray([query_vec], dtype=np.float32), 1)
+        if scores[0][0] >= QA_CACHE_THRESHOLD:
+            return answers[ids[0][0]]
+        return None
+
+
+def _store_answer(doc_key: str, query_vec: List[float], answer: str) -> None:
+    vec = np.asarray([query_vec], dtype=np.float32)
+    with _QA_LOCK:
+        entry = _QA_CACHE.get(doc_key)
+        if entry is None or len(entry[1]) >= QA_CACHE_SIZE:
+            entry = (faiss.IndexFlatIP(vec.shape[1]), [])
+            _QA_CACHE[doc_key] = entry
+        entry[0].add(vec)
+        entry[1].append(answer)
+        _QA_CACHE.move_to_end(doc_key)
+        while len(_QA_CACHE) > QA_CACHE_DOCS:
+            _QA_CACHE.popitem(last=False)
+
+
+# Conversation memory: verbatim recent turns within a token budget (~4 chars/token);
+# once this many turns pile up, the older ones are folded into a running summary
+HISTORY_RECENT_TURNS = 5
+HISTORY_TOKEN_BUDGET = 800
+HISTORY_COMPRESS_AT = 10
+# The newest turn is always kept, cut to the remaining budget but never below this
+HISTORY_MIN_LAST_TURN_TOKENS = 200
+# After a failed compression, wait this many turns before trying again
+HISTORY_COMPRESS_BACKOFF = 5
+# Hard cap on verbatim turns while compression is failing
+HISTORY_MAX_TURNS = 25
+
+
+def _approx_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+SUMMARY_FILE = "summary.txt"
+
+
+INDEX_FILE = "index.faiss"
+META_FILE = "meta.json"
 
 
 def _save_faiss(db: FAISS, path: str) -> None:
-    db.save_local(path)
+    """Write the raw FAISS index plus an orjson docstore blob (no pickle)."""
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(db.index, os.path.join(path, INDEX_FILE))
+    meta = {
+        "docs": [
+            {"id": doc_id, "page_content": doc.page_content, "metadata": doc.metadata}
+            for doc_id, doc in db.docstore._dict.items()
+        ],
+        # Position i in the index -> docstore id; a list since orjson keys must be str
+        "id_map": [db.index_to_docstore_id[i] for i in range(len(db.index_to_docstore_id))],
+    }
+    with open(os.path.join(path, META_FILE), "wb") as f:
+        f.write(orjson.dumps(meta))
+
+
+def _save_summary(path: str, summary: str) -> None:
+    """Persist a session summary next to its index files."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, SUMMARY_FILE), "w", encoding="utf-8") as f:
+        f.write(summary)
+
+
+def _load_summary(path: str) -> Optional[str]:
+    summary_path = os.path.join(path, SUMMARY_FILE)
+    if not os.path.exists(summary_path):
+        return None
+    with open(summary_path, encoding="utf-8") as f:
+        return f.read()
 
 
 def _load_faiss(path: str) -> FAISS:
-    return FAISS.load_local(path, EMB, allow_dangerous_deserialization=True)
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):  # index saved by the old pickle-based save_local
+        return FAISS.load_local(
+            path,
+            EMB,
+            allow_dangerous_deserialization=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+    # IO_FLAG_MMAP only affects IVF inverted lists (the IVF-PQ tier), which are then
+    # paged in on demand; HNSW indexes are still read fully into memory
+    index = faiss.read_index(os.path.join(path, INDEX_FILE), faiss.IO_FLAG_MMAP)
+    with open(meta_path, "rb") as f:
+        meta = orjson.loads(f.read())
+    docstore = InMemoryDocstore({
+        d["id"]: Document(page_content=d["page_content"], metadata=d["metadata"])
+        for d in meta["docs"]
+    })
+    return FAISS(
+        EMB,
+        index,
+        docstore,
+        dict(enumerate(meta["id_map"])),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
 
 
 # ---------------------------------------------------------------------
@@ -105,41 +479,53 @@ class DocumentSession:
         self.full_text = full_text
         self.is_general = is_general
         self.vector_store_path = os.path.join(VECTOR_STORE_DIR, self.session_id)
+        self.db: Optional[FAISS] = None  # in-memory index, reused by every query
+        # Key into the cross-session answer cache; general sessions have no document
+        self._doc_key: Optional[str] = (
+            None if is_general else hashlib.sha256(full_text.encode("utf-8")).hexdigest()
+        )
+        self._summary: Optional[str] = None
         if not self.is_general:
             self._prepare_vector_store()
         self.history: List[Dict[str, str]] = []
+        self.history_summary: str = ""
+        # Compression runs on a background thread; the lock guards history and summary
+        self._history_lock = threading.Lock()
+        self._compressing = False
+        self._turns = 0
+        self._next_compress_turn = 0
 
     # ------------------------------------------------------------
-    # STEP 1: Create FAISS index (streaming, memory-safe)
+    # STEP 1: Create FAISS index (batched embeddings)
     # ------------------------------------------------------------
     def _prepare_vector_store(self):
-        docs = _chunk_text(self.full_text)
-        print(f"[{self.session_id}] Split into {len(docs)} chunks.")
-        db = None
+        chunks = _chunk_text(self.full_text)
+        texts = _dedupe_chunks(chunks)
+        print(f"[{self.session_id}] Split into {len(chunks)} chunks ({len(texts)} unique).")
 
-        for i, doc in enumerate(docs, start=1):
-            try:
-                if db is None:
-                    db = FAISS.from_texts([doc.page_content], EMB)
-                else:
-                    db.add_texts([doc.page_content])
-                if i % 20 == 0 or i == len(docs):
-                    print(f"[{self.session_id}] Processed {i}/{len(docs)} chunks.")
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"[{self.session_id}] Error embedding chunk {i}: {e}")
-                continue
+        db = _build_faiss(texts, EMB._embed_matrix(texts))
+        print(f"[{self.session_id}] Embedded {len(texts)} chunks.")
 
         _save_faiss(db, self.vector_store_path)
+        self.db = db
         print(f"[{self.session_id}] Vector store saved at {self.vector_store_path}.")
 
     # ------------------------------------------------------------
     # STEP 2: Core Gemini generation
     # ------------------------------------------------------------
     def _generate(self, prompt: str) -> str:
-        model = genai.GenerativeModel(CHAT_MODEL)
-        resp = model.generate_content(prompt)
-        return getattr(resp, "text", "").strip() or "⚠️ No response generated."
+        resp = _CHAT.generate_content(prompt)
+        return getattr(resp, "text", "").strip() or NO_RESPONSE
+
+    def _generate_stream(self, prompt: str) -> Iterator[str]:
+        """Yield response text pieces as Gemini produces them."""
+        for chunk in _CHAT.generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:  # no parts: safety-blocked or finish-only chunk
+                continue
+            if text:
+                yield text
 
     # ------------------------------------------------------------
     # STEP 3: Document summary
@@ -149,19 +535,27 @@ class DocumentSession:
         Generate a concise executive summary for the uploaded or pasted document.
         Keep it short (≤ 250 words), factual, and well structured.
         """
-        prompt = (
-            "You are a Senior Legal Document Specialist.\n"
-            "Generate a high-level executive summary of the provided text.\n\n"
-            "REQUIREMENTS:\n"
-            "- Tone: Formal, objective, and precise.\n"
-            "- Format: Use professional markdown with semantic headers.\n"
-            "- Sections: Executive Overview, Key Parties, Significant Obligations, Critical Deadlines, and Potential Red Flags.\n\n"
-            "Document Text Segment:\n"
-            f"{self.full_text[:12000]}\n\n"
-            "Deliver the summary directly without any introductory conversational text."
-        )
-        
-        return self._generate(prompt)
+        if self._summary is None:
+            self._summary = _load_summary(self.vector_store_path)
+        if self._summary is not None:
+            return self._summary
+
+        excerpt = self.full_text[:12000]
+        key = hashlib.sha256(excerpt.encode("utf-8")).hexdigest()
+        cached = _cached_summary(key)
+        if cached is not None:
+            self._summary = cached
+            _save_summary(self.vector_store_path, cached)
+            return cached
+
+        prompt = _SUMMARY_TEMPLATE.format(excerpt=excerpt)
+
+        summary = self._generate(prompt)
+        if summary != NO_RESPONSE:
+            _store_summary(key, summary)
+            self._summary = summary
+            _save_summary(self.vector_store_path, summary)
+        return summary
 
     # ------------------------------------------------------------
     # STEP 4: Query answering (context + memory)
@@ -174,68 +568,153 @@ class DocumentSession:
         - If information is missing, give best-practice guidance first, then ask 2 to 3 clarifying questions.
         - Keep it concise and direct.
         """
+        prompt, cached, query_vec = self._prepare_answer(query)
+        if cached is not None:
+            self._remember(query, cached)
+            return cached
+
+        answer = self._generate(prompt)
+        self._finish_answer(query, query_vec, answer)
+        return answer
+
+    def answer_query_stream(self, query: str) -> Iterator[str]:
+        """
+        Same as answer_query, but returns an iterator over the answer pieces as they
+        are generated. Embedding, retrieval and prompt building run eagerly here, so
+        their errors surface to the caller before any response is sent.
+        The full text is recorded in history once the stream completes.
+        """
+        prompt, cached, query_vec = self._prepare_answer(query)
+        if cached is not None:
+            self._remember(query, cached)
+            return iter([cached])
+        return self._stream_answer(query, query_vec, prompt)
+
+    def _stream_answer(
+        self, query: str, query_vec: Optional[List[float]], prompt: str
+    ) -> Iterator[str]:
+        parts: List[str] = []
+        for piece in self._generate_stream(prompt):
+            parts.append(piece)
+            yield piece
+        answer = "".join(parts).strip()
+        if not answer:
+            answer = NO_RESPONSE
+            yield answer
+        self._finish_answer(query, query_vec, answer)
+
+    def _prepare_answer(
+        self, query: str
+    ) -> Tuple[str, Optional[str], Optional[List[float]]]:
+        """
+        Build the answer prompt for `query`.
+        Returns (prompt, cached_answer, query_vec); on a semantic cache hit the
+        prompt is empty and cached_answer holds the reusable answer. query_vec is
+        None unless the answer may be cached.
+        """
+        query_vec: Optional[List[float]] = None
+        # Answers depend on the conversation so far; only opening turns are cacheable
+        cacheable = not self.history and not self.history_summary
+        safety_block = ""
         # Retrieve top chunks for grounding
         if self.is_general:
-            context = "General Legal Help - No specific document context provided. You are to act as a general legal assistant advising on common legal issues based on your instructions. Note: This is an ungrounded chat about the user's generic problem."
+            context = _GENERAL_CONTEXT
         else:
-            db = _load_faiss(self.vector_store_path)
-            retriever = db.as_retriever(search_kwargs={"k": 6})
-            docs = retriever.get_relevant_documents(query or "next steps action plan")
+            if self.db is None:  # e.g. a session object restored without its index
+                self.db = _load_faiss(self.vector_store_path)
+            db = self.db
+            # Embed once: the vector serves both the answer cache and retrieval
+            query_vec = EMB.embed_query(query or "next steps action plan")
+            if cacheable:
+                cached = _cached_answer(self._doc_key, query_vec)
+                if cached is not None:
+                    return "", cached, query_vec
+            docs = db.similarity_search_by_vector(query_vec, k=6)
             context = "\n\n".join(d.page_content for d in docs)
-
-        # Safety net: include a small slice of the full text to avoid “no context” answers
-        safety_slice = self.full_text[:2000] if not self.is_general else ""
+            # Safety net: only when retrieval returned nothing, fall back to a slice of
+            # the full text to avoid “no context” answers
+            if not docs:
+                safety_block = f"--- Safety slice ---\n{self.full_text[:2000]}\n"
 
         # Light conversation memory
-        history_block = ""
-        if self.history:
-            pairs = [f"User: {h['user']}\nAssistant: {h['assistant']}" for h in self.history[-5:]]
-            history_block = "Recent conversation:\n" + "\n\n".join(pairs) + "\n\n"
-
-        # Determine context constraints based on mode
-        if self.is_general:
-            persona = (
-                "You are an elite legal strategist. You are providing general guidance without a specific document.\n"
-                "FOCUS: Practical first steps, risk mitigation, and identifying which specialist (e.g., criminal lawyer, employment tribunal) is needed."
-            )
-            context_guidance = (
-                "Since no document is uploaded, provide high-level strategic advice based on general legal principles. "
-                "Structure your response with clear, actionable bullet points."
-            )
-        else:
-            persona = (
-                "You are an elite legal analyst. Use the provided document as your sole source of truth."
-            )
-            context_guidance = (
-                "Always ground your answer in the provided document context. If the document is silent, "
-                "state so clearly and then provide best-practice guidance as a secondary measure."
-            )
-
-        # Concise, structured prompt
-        prompt = (
-            f"{persona}\n\n"
-            f"{context_guidance}\n\n"
-            "RESPONSE STYLE:\n"
-            "- Tone: Authoritative, professional, but accessible.\n"
-            "- Structure: Primary Answer -> Action Steps -> Strategic Considerations.\n"
-            "- Conciseness: Maximum 200 words.\n\n"
-            
-            f"{history_block}"
-            f"User Question: {query}\n\n"
-        
-            "--- Context / Strategic Instructions ---\n"
-            f"{context}\n"
-            "------------------------------------------\n\n"
-        
-            "Now deliver your final guidance in professional markdown."
+        history_block = self._history_block()
+
+        # Concise, structured prompt; persona and guidance depend on mode
+        prompt = _QA_TEMPLATE.format(
+            persona=_GENERAL_PERSONA if self.is_general else _DOCUMENT_PERSONA,
+            context_guidance=_GENERAL_GUIDANCE if self.is_general else _DOCUMENT_GUIDANCE,
+            history_block=history_block,
+            query=query,
+            context=context,
+            safety_block=safety_block,
         )
-        
-
-        answer = self._generate(prompt)
+        return prompt, None, query_vec if cacheable else None
 
-        # Store history
-        self.history.append({"user": query, "assistant": answer})
-        if len(self.history) > 25:
-            self.history = self.history[-25:]
+    def _finish_answer(self, query: str, query_vec: Optional[List[float]], answer: str) -> None:
+        if query_vec is not None and answer != NO_RESPONSE:
+            _store_answer(self._doc_key, query_vec, answer)
+        self._remember(query, answer)
 
-        return answer
+    # ------------------------------------------------------------
+    # Conversation memory
+    # ------------------------------------------------------------
+    def _remember(self, query: str, answer: str) -> None:
+        """
+        Store a turn. Once enough pile up, older turns are folded into the summary
+        on a background thread, so no answer waits on the extra Gemini call.
+        """
+        older = None
+        with self._history_lock:
+            self.history.append({"user": query, "assistant": answer})
+            self._turns += 1
+            if self._compressing:
+                return
+            if len(self.history) > HISTORY_MAX_TURNS:  # backstop if compression keeps failing
+                self.history = self.history[-HISTORY_MAX_TURNS:]
+            if len(self.history) >= HISTORY_COMPRESS_AT and self._turns >= self._next_compress_turn:
+                self._compressing = True
+                older = self.history[:-HISTORY_RECENT_TURNS]
+        if older:
+            threading.Thread(target=self._compress_history, args=(older,), daemon=True).start()
+
+    def _compress_history(self, older: List[Dict[str, str]]) -> None:
+        turns = "\n\n".join(f"User: {h['user']}\nAssistant: {h['assistant']}" for h in older)
+        prompt = _HISTORY_TEMPLATE.format(summary=self.history_summary or "(none)", turns=turns)
+        try:
+            summary = self._generate(prompt)
+        except Exception as e:
+            print(f"[{self.session_id}] History compression failed, keeping turns: {e}")
+            summary = NO_RESPONSE
+        with self._history_lock:
+            self._compressing = False
+            if summary == NO_RESPONSE:
+                self._next_compress_turn = self._turns + HISTORY_COMPRESS_BACKOFF
+                return
+            self.history_summary = summary
+            # Turns added while the summary was generated stay verbatim
+            self.history = self.history[len(older):]
+
+    def _history_block(self) -> str:
+        """Summary of older turns plus the newest turns that fit the token budget."""
+        budget = HISTORY_TOKEN_BUDGET
+        sections = []
+        if self.history_summary:
+            sections.append(f"Earlier conversation (summary):\n{self.history_summary}")
+            budget -= _approx_tokens(self.history_summary)
+
+        pairs: List[str] = []
+        for h in reversed(self.history[-HISTORY_RECENT_TURNS:]):
+            pair = f"User: {h['user']}\nAssistant: {h['assistant']}"
+            cost = _approx_tokens(pair)
+            if cost > budget:
+                if not pairs:
+                    # Follow-ups ("explain that") need the last exchange: keep its start
+                    chars = max(budget, HISTORY_MIN_LAST_TURN_TOKENS) * 4
+                    pairs.append(pair[:chars].rstrip() + " …")
+                break
+            pairs.append(pair)
+            budget -= cost
+        if pairs:
+            sections.append("Recent conversation:\n" + "\n\n".join(reversed(pairs)))
+
+        return "\n\n".join(sections) + "\n\n" if sections else ""
@@ -1,17 +1,22 @@
 from __future__ import annotations
 import argparse
+import hashlib
 import os
+import string
 import sys
+import threading
 from dataclasses import dataclass
-from typing import List, Tuple, Dict
+from typing import Iterable, List, Tuple, Dict, Optional
 
 import joblib
 import numpy as np
+from scipy.sparse import spmatrix
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report, confusion_matrix
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import SGDClassifier  # logistic regression via log loss
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.multiclass import OneVsRestClassifier
 
 
 # ----------------------------
@@ -20,6 +25,18 @@ from sklearn.linear_model import SGDClassifier  # logistic regression via log lo
 SEED = 42
 ARTIFACT_DIR = os.path.join(os.path.dirname(__file__), "..", "ml_artifacts")
 MODEL_PATH = os.path.abspath(os.path.join(ARTIFACT_DIR, "legal_issue_clf.pkl"))
+# Fitted feature steps + the transformed training matrix, reused while the data is unchanged
+FEATURES_PATH = os.path.abspath(os.path.join(ARTIFACT_DIR, "legal_issue_features.pkl"))
+
+# Punctuation -> space before tokenizing. "_" is a word character for the token
+# regex, so it is kept; every other mapping leaves the produced tokens unchanged.
+PUNCT_TABLE = str.maketrans({c: " " for c in string.punctuation if c != "_"})
+
+# Loaded once per process and reused by every prediction
+_model_cache: Optional[Tuple[Pipeline, List[str]]] = None
+# (feature steps, W, b) specialized from the cached model; see _specialize()
+_head_cache: Optional[Tuple[Pipeline, np.ndarray, np.ndarray]] = None
+_model_lock = threading.Lock()
 
 
 # ----------------------------
@@ -89,31 +106,64 @@ def _dataset() -> List[Example]:
 # ----------------------------
 def build_pipeline() -> Pipeline:
     """
-    Text -> TF-IDF -> Linear classifier (SGD with log loss ~ logistic regression).
-    We keep it simple and fast, with calibrated decision_function for confidence.
+    Text -> hashed n-gram counts -> TF-IDF -> Linear classifier (one-vs-rest logistic
+    regression, liblinear solver). Hashing keeps no vocabulary dict, so transform is stateless
+    apart from the idf_ weights.
+    liblinear's coordinate descent converges in a handful of passes on small sparse
+    data; decision_function is still used for confidence.
     """
     return Pipeline(
         steps=[
-            ("tfidf", TfidfVectorizer(
+            ("hash", HashingVectorizer(
+                # A few hundred distinct n-grams: 4096 buckets keep collisions rare while
+                # coef_ (classes x n_features) and idf_ stay small in the artifact
+                n_features=2**12,
                 ngram_range=(1, 2),
-                min_df=1,
-                max_df=0.9,
-                sublinear_tf=True,
+                alternate_sign=False,
+                norm=None,  # TfidfTransformer normalizes after weighting
                 lowercase=True,
                 stop_words="english")),
-            ("clf", SGDClassifier(
-                loss="log_loss",  # logistic regression
-                alpha=1e-4,
-                max_iter=2000,
-                tol=1e-3,
-                random_state=SEED))
+            ("tfidf", TfidfTransformer(sublinear_tf=True)),
+            # liblinear is binary-only; OneVsRestClassifier fits one model per class
+            ("clf", OneVsRestClassifier(LogisticRegression(
+                solver="liblinear",
+                # ~1 / (alpha * n_train) for the former SGD alpha=1e-4 on 27 rows;
+                # the default C=1.0 flattens confidences toward uniform
+                C=370.0,
+                random_state=SEED)))
         ]
     )
 
 
+def _features_hash(texts: Iterable[str], features: Pipeline) -> str:
+    """Fingerprint of the training texts plus the feature-step configuration."""
+    h = hashlib.md5()
+    for name, step in features.steps:
+        h.update(f"{name}:{sorted(step.get_params().items())!r}".encode("utf-8"))
+    for text in texts:
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _load_cached_features(dataset_hash: str) -> Optional[Tuple[Pipeline, spmatrix]]:
+    """Return (fitted feature steps, transformed X_train) from a previous run if the data is unchanged."""
+    if not os.path.exists(FEATURES_PATH):
+        return None
+    try:
+        bundle = joblib.load(FEATURES_PATH)
+    except Exception as e:
+        print(f"Ignoring unreadable feature cache: {e}")
+        return None
+    if bundle.get("dataset_hash") != dataset_hash:
+        return None
+    return bundle["vectorizer"], bundle["X_train"]
+
+
 def train_model() -> Tuple[Pipeline, Dict[str, int]]:
+    global _model_cache, _head_cache
     data = _dataset()
-    X = [ex.text for ex in data]
+    X = np.asarray([ex.text for ex in data], dtype=object)  # split by fancy indexing
     y = [ex.label for ex in data]
 
     labels = sorted(list(set(y)))
@@ -125,7 +175,16 @@ def train_model() -> Tuple[Pipeline, Dict[str, int]]:
     )
 
     pipe = build_pipeline()
-    pipe.fit(X_train, y_train)
+    dataset_hash = _features_hash(X_train, pipe[:-1])
+    cached = _load_cached_features(dataset_hash)
+    if cached is not None:
+        # Same texts, same config: skip tokenizing and fit only the classifier
+        print("Reusing cached TF-IDF features.")
+        vectorizer, Xt_train = cached
+        pipe = Pipeline(steps=vectorizer.steps + pipe.steps[-1:])
+    else:
+        Xt_train = pipe[:-1].fit_transform(X_train)
+    pipe.named_steps["clf"].fit(Xt_train, y_train)
 
     # Evaluate
     y_pred = pipe.predict(X_test)
@@ -136,13 +195,20 @@ def train_model() -> Tuple[Pipeline, Dict[str, int]]:
 
     # Persist artifacts
     os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    # Left uncompressed on purpose: joblib cannot memory-map compressed pickles
     joblib.dump({"model": pipe, "labels": labels}, MODEL_PATH)
+    if cached is None:
+        joblib.dump(
+            {"vectorizer": pipe[:-1], "X_train": Xt_train, "dataset_hash": dataset_hash},
+            FEATURES_PATH,
+        )
     print(f"\nSaved model to: {MODEL_PATH}")
+    _model_cache = _head_cache = None  # next load_model() picks up the fresh artifact
 
     return pipe, label_to_id
 
 
-def load_model() -> Tuple[Pipeline, List[str]]:
+def _load_model_uncached() -> Tuple[Pipeline, List[str]]:
     if not os.path.exists(MODEL_PATH):
         print("Model artifact not found; training a fresh one...")
         pipe, label_to_id = train_model()
@@ -151,29 +217,84 @@ def load_model() -> Tuple[Pipeline, List[str]]:
             labels[v] = k
         return pipe, labels
 
-    bundle = joblib.load(MODEL_PATH)
+    # Arrays (coef_, idf_) are memory-mapped read-only, so forked workers share pages
+    bundle = joblib.load(MODEL_PATH, mmap_mode="r")
     return bundle["model"], bundle["labels"]
 
 
+def _specialize(model: Pipeline) -> Tuple[Pipeline, np.ndarray, np.ndarray]:
+    """
+    Split a fitted pipeline into its feature steps and a linear head (W, b) with
+    exactly one column per class, so scores are a single `features @ W + b`.
+    The binary single-column layout is expanded here instead of on every call.
+    """
+    clf = model.named_steps["clf"]
+    # One binary model per class under OneVsRestClassifier; older artifacts hold a single one
+    estimators = clf.estimators_ if hasattr(clf, "estimators_") else [clf]
+    W = np.vstack([est.coef_ for est in estimators]).T
+    b = np.concatenate([np.ravel(est.intercept_) for est in estimators])
+    if W.shape[1] == 1:  # binary: coef_ scores only the positive class
+        W = np.hstack([-W, W])
+        b = np.concatenate([-b, b])
+    return model[:-1], W, b
+
+
+def load_model() -> Tuple[Pipeline, List[str]]:
+    """
+    Return the (pipeline, labels) pair, loading it from disk only on first use.
+    Safe to call from concurrent request handlers.
+    """
+    global _model_cache, _head_cache
+    if _model_cache is None:
+        with _model_lock:
+            if _model_cache is None:
+                model, labels = _load_model_uncached()
+                _head_cache = _specialize(model)
+                _model_cache = model, labels
+    return _model_cache
+
+
+def _argmax_softmax(scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row-wise argmax and the softmax probability of that argmax.
+    The winning class contributes exp(0) = 1 to the shifted sum, so its probability
+    is 1 / sum(exp(s - max)); the rest of the softmax row is never materialized.
+    """
+    preds = scores.argmax(axis=1)
+    top = scores[np.arange(scores.shape[0]), preds]
+    conf = 1.0 / np.exp(scores - top[:, None]).sum(axis=1)
+    return preds, conf
+
+
+def predict_texts(texts: List[str]) -> List[Dict[str, str]]:
+    """
+    Predict legal issue labels for a batch of texts in one vectorization pass.
+    Returns one {"label": str, "confidence": float (0..1)} per input, in order.
+    """
+    results: List[Dict[str, str]] = [{"label": "Unknown", "confidence": 0.0} for _ in texts]
+    idx = [i for i, t in enumerate(texts) if t and t.strip()]
+    if not idx:
+        return results
+
+    _, labels = load_model()
+    features, W, b = _head_cache
+    # One transform + one sparse-dense product; same scores as decision_function
+    # without sklearn's per-call input validation
+    X = features.transform([texts[i].translate(PUNCT_TABLE) for i in idx])
+    scores = np.asarray(X @ W) + b
+    preds, conf = _argmax_softmax(scores)
+
+    for row, i in enumerate(idx):
+        results[i] = {"label": labels[preds[row]], "confidence": round(float(conf[row]), 4)}
+    return results
+
+
 def predict_text(text: str) -> Dict[str, str]:
     """
     Predict the legal issue label for a given text.
     Returns: {"label": str, "confidence": float (0..1)}
     """
-    if not text or not text.strip():
-        return {"label": "Unknown", "confidence": 0.0}
-
-    model, labels = load_model()
-    pred = model.predict([text])[0]
-    # Use decision_function to get a pseudo-confidence; softmax-ish normalization
-    scores = model.decision_function([text])[0]
-    if scores.ndim == 0:  # binary edge-case
-        scores = np.array([scores, -scores])
-    exp = np.exp(scores - scores.max())
-    probs = exp / exp.sum()
-    confidence = float(probs[pred])
-
-    return {"label": labels[pred], "confidence": round(confidence, 4)}
+    return predict_texts([text])[0]
 
 
 # ----------------------------
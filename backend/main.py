@@ -1,13 +1,17 @@
+import asyncio
 import os
 import uuid
 import traceback
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
 from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from Agent import DocumentSession
+import MachineLearning
 
 # -------------------------------------------------
 # App init
@@ -36,6 +40,10 @@ app.add_middleware(
 # In-memory session registry (ok for dev/demo)
 sessions: Dict[str, Dict[str, Any]] = {}
 
+# Classifier micro-batching: flush at this many queued texts or after this wait
+CLASSIFY_MAX_BATCH = int(os.getenv("CLASSIFY_MAX_BATCH", "32"))
+CLASSIFY_MAX_WAIT_MS = float(os.getenv("CLASSIFY_MAX_WAIT_MS", "20"))
+
 
 # -------------------------------------------------
 # Models
@@ -67,9 +75,79 @@ class AgentResponse(BaseModel):
     response: str
 
 
+class ClassifyRequest(BaseModel):
+    text: str
+
+
+class ClassifyResponse(BaseModel):
+    label: str
+    confidence: float
+
+
 # -------------------------------------------------
 # Helpers
 # -------------------------------------------------
+class PredictionBatcher:
+    """
+    Collects concurrent classify calls for up to `max_wait_ms` (or `max_batch`
+    texts) and scores them with one MachineLearning.predict_texts call.
+    """
+
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def predict(self, text: str) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Tuple[str, asyncio.Future]] = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await asyncio.to_thread(
+                    MachineLearning.predict_texts, [text for text, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+classifier_batcher = PredictionBatcher(CLASSIFY_MAX_BATCH, CLASSIFY_MAX_WAIT_MS)
+
+
 def _process_text_background(text: str, session_id: str, filename: str) -> None:
     """Build vector store + initial summary, then mark session READY."""
     print(f"[{session_id}] Background processing started for {filename}")
@@ -91,6 +169,27 @@ def _process_text_background(text: str, session_id: str, filename: str) -> None:
         sessions[session_id]["status"] = "ERROR"
 
 
+# -------------------------------------------------
+# Startup
+# -------------------------------------------------
+@app.on_event("startup")
+async def _warm() -> None:
+    """Load and warm the issue classifier once per worker so no request pays for it."""
+    try:
+        MachineLearning.load_model()
+        # First transform builds the analyzer and compiles the token regex
+        MachineLearning.predict_text("warmup text for the analyzer")
+    except Exception:
+        # Document sessions don't need the classifier; /classify retries the lazy load
+        traceback.print_exc()
+    classifier_batcher.start()
+
+
+@app.on_event("shutdown")
+async def _stop_batcher() -> None:
+    await classifier_batcher.stop()
+
+
 # -------------------------------------------------
 # Routes
 # -------------------------------------------------
@@ -153,13 +252,42 @@ async def query_session(request: QueryRequest):
 
     try:
         doc_session: DocumentSession = session["session_object"]
-        answer = doc_session.answer_query(request.query)
+        # Off the event loop: rate limiting and retry backoff sleep while embedding
+        answer = await run_in_threadpool(doc_session.answer_query, request.query)
         return {"response": answer}
     except Exception:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail="Agent encountered an error.")
 
 
+@app.post("/session/query/stream")
+async def query_session_stream(request: QueryRequest):
+    session = sessions.get(request.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    if session.get("status") != "READY" or not session.get("session_object"):
+        raise HTTPException(status_code=400, detail="Session not ready.")
+
+    try:
+        doc_session: DocumentSession = session["session_object"]
+        # Retrieval and prompt building happen here, so their errors still map to a 500
+        pieces = await run_in_threadpool(doc_session.answer_query_stream, request.query)
+    except Exception:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail="Agent encountered an error.")
+    # Sync iterator: Starlette iterates it in a worker thread, sending pieces as they arrive
+    return StreamingResponse(pieces, media_type="text/plain")
+
+
+@app.post("/classify", response_model=ClassifyResponse)
+async def classify(request: ClassifyRequest):
+    try:
+        return await classifier_batcher.predict(request.text)
+    except Exception:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail="Classifier encountered an error.")
+
+
 # Add this at the very end of backend/main.py
 import uvicorn
 